@@ -3,12 +3,15 @@
 """
 from pathlib import Path
 
-from keras.preprocessing.image import img_to_array
-from keras.models import load_model
+from tensorflow.keras.preprocessing.image import img_to_array
+from tensorflow.keras.models import load_model
 import cv2
 import glob
 import numpy as np
 
+import deploy
+import utils
+
 # Parameters
 face_detection_path = str(Path('data/haarcascade_frontalface_default.xml'))
 model_path = str(Path('models/model.best.hdf5'))
@@ -18,6 +21,8 @@ emotions = ['Angry', 'Disgust', 'Fear', 'Happy', 'Sad', 'Surprise', 'Neutral']
 # Our face detector and trained model
 face_detector = cv2.CascadeClassifier(face_detection_path)
 emotion_classifier = load_model(model_path, compile=False)
+# Checkpoints saved during mixed precision training are run in float32
+emotion_classifier = deploy.to_float32(emotion_classifier)
 
 # Gathers a list of all the images in the project directory. 
 images = glob.glob('*.jpg') + glob.glob('*.jpeg') + glob.glob('*.png')
@@ -36,6 +41,7 @@ if images:
     roi = roi.astype("float") / 255.0
     roi = img_to_array(roi)
     roi = np.expand_dims(roi, axis=0)
+    roi = utils.pad_channels(roi, emotion_classifier.input_shape[-1])
     
     # Labels each picture with an expression
     predictions = emotion_classifier.predict(roi)[0]
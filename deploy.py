@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for preparing a trained model for deployment.
+"""
+from tensorflow.keras.layers import Activation, BatchNormalization
+from tensorflow.keras.layers import Conv2D, SeparableConv2D
+from tensorflow.keras.models import clone_model
+import numpy as np
+import tensorflow as tf
+
+def to_float32(model):
+    """Returns a copy of model whose layers all compute in float32.
+    
+    Layers trained under a mixed precision policy would otherwise keep 
+    running in bfloat16 or float16 wherever the model is loaded.
+    """
+    def clone_layer(layer):
+        config = layer.get_config()
+        config['dtype'] = 'float32'
+        return layer.__class__.from_config(config)
+    
+    float_model = clone_model(model, clone_function=clone_layer)
+    float_model.set_weights(model.get_weights())
+    return float_model
+
+def fold_batchnorm(model):
+    """Folds every BatchNormalization into the convolution before it.
+    
+    Returns a copy of model where those convolutions have a bias holding 
+    the normalization and each folded BatchNormalization is replaced by an 
+    identity. For separable convolutions only the pointwise kernel 
+    is scaled. A ReLU right after a folded BatchNormalization becomes the 
+    activation of the convolution, so it runs in the same kernel. Every 
+    layer of the copy computes in float32.
+    """
+    producers = {id(layer.output): layer for layer in model.layers}
+    consumers = {}
+    for layer in model.layers:
+        for tensor in tf.nest.flatten(layer.input):
+            consumers.setdefault(id(tensor), []).append(layer)
+    
+    # Finds the convolutions whose only consumer is a BatchNormalization
+    folds = {}
+    for layer in model.layers:
+        if not isinstance(layer, BatchNormalization):
+            continue
+        conv = producers.get(id(layer.input))
+        if (isinstance(conv, (Conv2D, SeparableConv2D))
+                and not conv.use_bias 
+                and len(consumers[id(conv.output)]) == 1):
+            folds[conv.name] = layer
+    folded_norms = {norm.name for norm in folds.values()}
+    
+    # Finds the ReLUs that are the only consumer of a folded normalization
+    relus = {}
+    for name, norm in folds.items():
+        next_layers = consumers.get(id(norm.output), [])
+        if (len(next_layers) == 1 
+                and isinstance(next_layers[0], Activation) 
+                and next_layers[0].get_config()['activation'] == 'relu'):
+            relus[name] = next_layers[0]
+    fused_relus = {relu.name for relu in relus.values()}
+    
+    def clone_layer(layer):
+        if layer.name in folded_norms or layer.name in fused_relus:
+            return Activation('linear', name=layer.name, dtype='float32')
+        config = layer.get_config()
+        config['dtype'] = 'float32'
+        if layer.name in folds:
+            config['use_bias'] = True
+        if layer.name in relus:
+            config['activation'] = 'relu'
+        return layer.__class__.from_config(config)
+    
+    folded_model = clone_model(model, clone_function=clone_layer)
+    for layer in model.layers:
+        if layer.name in folded_norms or layer.name in fused_relus:
+            continue
+        weights = layer.get_weights()
+        if layer.name in folds:
+            norm = folds[layer.name]
+            gamma, beta, mean, variance = norm.get_weights()
+            scale = gamma / np.sqrt(variance + norm.epsilon)
+            # The last kernel is the one holding the output channels
+            weights[-1] = weights[-1] * scale
+            weights.append(beta - mean * scale)
+        folded_model.get_layer(layer.name).set_weights(weights)
+    return folded_model
+
+def quantize(model, images, num_samples=100):
+    """Converts model into an INT8 TensorFlow Lite model.
+    
+    A float32 copy of model is quantized after training, with the first 
+    num_samples images calibrating the activation ranges. Returns the 
+    serialized TensorFlow Lite model.
+    """
+    float_model = to_float32(model)
+    
+    def representative_dataset():
+        for i in range(min(num_samples, len(images))):
+            yield [np.asarray(images[i:i + 1], dtype=np.float32)]
+    
+    converter = tf.lite.TFLiteConverter.from_keras_model(float_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+    return converter.convert()
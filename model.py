@@ -7,40 +7,56 @@ https://github.com/oarriaga/face_classification
 """
 from pathlib import Path
 
-from keras.callbacks import CSVLogger, ModelCheckpoint, EarlyStopping
-from keras.callbacks import ReduceLROnPlateau
-from keras.preprocessing.image import ImageDataGenerator
-from keras.layers import Activation, Conv2D
-from keras.layers import BatchNormalization
-from keras.layers import GlobalAveragePooling2D
-from keras.layers import MaxPooling2D, Input
-from keras.layers import SeparableConv2D
-from keras.models import Model
-from keras import layers
-from keras.regularizers import l2
+from tensorflow.keras.callbacks import CSVLogger, ModelCheckpoint, EarlyStopping
+from tensorflow.keras.callbacks import ReduceLROnPlateau, CallbackList
+from tensorflow.keras.layers import Activation, Conv2D
+from tensorflow.keras.layers import BatchNormalization
+from tensorflow.keras.layers import GlobalAveragePooling2D
+from tensorflow.keras.layers import MaxPooling2D, Input
+from tensorflow.keras.layers import SeparableConv2D
+from tensorflow.keras.models import Model
+from tensorflow.keras.optimizers import AdamW
+from tensorflow.keras import layers
+from tensorflow.keras import mixed_precision
 import numpy as np
+import tensorflow as tf
 
+import deploy
 import utils
 
 # Parameters
-batch_size = 32
+# Multiple of 256 for efficient convolution tiling, the learning rate is 
+# scaled up from the Adam default used at a batch size of 32
+batch_size = 256
+learning_rate = 1e-3 * (batch_size / 32) ** 0.5
 num_epochs = 250
 num_classes = 7
 wait_time = 50
-input_shape = (48, 48, 1)
-regularization = l2(0.01)
+# Grayscale images are zero padded to 4 channels for Tensor Core eligibility
+input_shape = (48, 48, 4)
+weight_decay = 0.01
 data_folder = Path('data/fer2013.csv')
+# Images are cast and cached once in half precision
+data_dtype = np.float16
+
+# Mixed precision, 'mixed_bfloat16' for Ampere or newer GPUs and 
+# 'mixed_float16' for older ones
+precision_policy = 'mixed_bfloat16'
+mixed_precision.set_global_policy(precision_policy)
+tf.keras.backend.set_image_data_format('channels_last')
 
 # Fine tuning Model, only do with already trained models
 fine_tune = True
+frozen_layers = 10
 
 # Loads saved numpy arrays if available. Otherwise creates it with load_data. 
+# Images from older float32 caches are cast once here.
 try:
-    X_train = np.load(Path('data/X_train.npy'))
+    X_train = np.load(Path('data/X_train.npy')).astype(data_dtype, copy=False)
     Y_train = np.load(Path('data/Y_train.npy'))
-    X_val = np.load(Path('data/X_val.npy'))
+    X_val = np.load(Path('data/X_val.npy')).astype(data_dtype, copy=False)
     Y_val = np.load(Path('data/Y_val.npy'))
-    X_test = np.load(Path('data/X_test.npy'))
+    X_test = np.load(Path('data/X_test.npy')).astype(data_dtype, copy=False)
     Y_test = np.load(Path('data/Y_test.npy'))    
     print('NUMPY DATA LOADED.')   
 except:  
@@ -50,38 +66,68 @@ except:
     
     X_train, Y_train = utils.load_data(emotions,
                                        data_folder,
-                                       usage='Training')
+                                       usage='Training',
+                                       dtype=data_dtype)
     X_val, Y_val     = utils.load_data(emotions,
                                        data_folder,
-                                       usage='PublicTest')
+                                       usage='PublicTest',
+                                       dtype=data_dtype)
     X_test, Y_test   = utils.load_data(emotions,
                                            data_folder,
-                                       usage='PrivateTest')
+                                       usage='PrivateTest',
+                                       dtype=data_dtype)
     
     utils.save_data(X_train, Y_train, 'train')
     utils.save_data(X_val, Y_val, 'val')
     utils.save_data(X_test, Y_test, 'test')
     print('NUMPY DATA SAVED..')
 
-# Preprocessing the data
-datagen = ImageDataGenerator(featurewise_center=False,
-                             featurewise_std_normalization=False,
-                             rotation_range=10,
-                             width_shift_range=0.1,
-                             height_shift_range=0.1,
-                             zoom_range=.1,
-                             horizontal_flip=True)
+# Preloads the whole dataset on the GPU, if there is one, so batches are 
+# gathered on the device instead of being copied over every step. The images
+# stay grayscale and each batch is only zero padded to 4 channels after it is
+# gathered and augmented.
+device = '/GPU:0' if tf.config.list_physical_devices('GPU') else '/CPU:0'
+with tf.device(device):
+    X_train = tf.identity(X_train)
+    Y_train = tf.identity(Y_train)
+    X_val = tf.identity(X_val)
+    Y_val = tf.identity(Y_val)
+channel_padding = [[0, 0], [0, 0], [0, 0], 
+                   [0, input_shape[-1] - X_train.shape[-1]]]
+
+# Only shuffled batches of indices into the training set go through tf.data.
+# Partial batches are dropped so every step has the same shapes and XLA and 
+# cuDNN only tune them once
+train_ds = (tf.data.Dataset.range(len(X_train))
+            .shuffle(len(X_train))
+            .batch(batch_size, drop_remainder=True))
+# The next batches are copied to the GPU while the current step runs
+if device == '/GPU:0':
+    train_ds = train_ds.apply(
+        tf.data.experimental.prefetch_to_device(device, buffer_size=2))
+else:
+    train_ds = train_ds.prefetch(tf.data.AUTOTUNE)
+steps_per_epoch = len(X_train) // batch_size
+validation_steps = len(X_val) // batch_size
+if steps_per_epoch == 0 or validation_steps == 0:
+    raise ValueError('The training and validation sets need at least one '
+                     'full batch of %d images each.' % batch_size)
+
+# The validation set never changes, so it is batched on the device once and 
+# the same batches are reused every epoch
+with tf.device(device):
+    val_batches = [(tf.pad(X_val[step * batch_size:(step + 1) * batch_size],
+                           channel_padding),
+                    Y_val[step * batch_size:(step + 1) * batch_size])
+                   for step in range(validation_steps)]
     
 # Mini-Xception architecture
-input_shape = (48, 48, 1)
 img_input = Input(input_shape)
 x = Conv2D(8, (3, 3), strides=(1, 1),
-           kernel_regularizer=regularization,
            use_bias=False)(img_input)   
 x = BatchNormalization()(x)
 x = Activation('relu')(x)
 x = Conv2D(8, (3, 3), strides=(1, 1), 
-           kernel_regularizer=regularization,
            use_bias=False)(x)
 x = BatchNormalization()(x)
 x = Activation('relu')(x)
@@ -91,12 +137,10 @@ residual = Conv2D(16, (1, 1), strides=(2, 2),
                   padding='same', use_bias=False)(x)
 residual = BatchNormalization()(residual)
 x = SeparableConv2D(16, (3, 3), padding='same',
-                    kernel_regularizer=regularization,
                     use_bias=False)(x)
 x = BatchNormalization()(x)
 x = Activation('relu')(x)
 x = SeparableConv2D(16, (3, 3), padding='same',
-                    kernel_regularizer=regularization,
                     use_bias=False)(x)
 x = BatchNormalization()(x)
 x = MaxPooling2D((3, 3), strides=(2, 2), padding='same')(x)
@@ -107,12 +151,10 @@ residual = Conv2D(32, (1, 1), strides=(2, 2),
                   padding='same', use_bias=False)(x)
 residual = BatchNormalization()(residual)
 x = SeparableConv2D(32, (3, 3), padding='same',
-                    kernel_regularizer=regularization,
                     use_bias=False)(x)
 x = BatchNormalization()(x)
 x = Activation('relu')(x)
 x = SeparableConv2D(32, (3, 3), padding='same',
-                    kernel_regularizer=regularization,
                     use_bias=False)(x)
 x = BatchNormalization()(x)
 x = MaxPooling2D((3, 3), strides=(2, 2), padding='same')(x)
@@ -123,13 +165,11 @@ residual = Conv2D(64, (1, 1), strides=(2, 2),
                       padding='same', use_bias=False)(x)
 residual = BatchNormalization()(residual)
 x = SeparableConv2D(64, (3, 3), padding='same',
-                        kernel_regularizer=regularization,
-                        use_bias=False)(x)
+                    use_bias=False)(x)
 x = BatchNormalization()(x)
 x = Activation('relu')(x)
 x = SeparableConv2D(64, (3, 3), padding='same',
-                        kernel_regularizer=regularization,
-                        use_bias=False)(x)
+                    use_bias=False)(x)
 x = BatchNormalization()(x)
 x = MaxPooling2D((3, 3), strides=(2, 2), padding='same')(x)
 x = layers.add([x, residual])
@@ -139,40 +179,72 @@ residual = Conv2D(128, (1, 1), strides=(2, 2),
                       padding='same', use_bias=False)(x)
 residual = BatchNormalization()(residual)
 x = SeparableConv2D(128, (3, 3), padding='same',
-                        kernel_regularizer=regularization,
-                        use_bias=False)(x)
+                    use_bias=False)(x)
 x = BatchNormalization()(x)
 x = Activation('relu')(x)
 x = SeparableConv2D(128, (3, 3), padding='same',
-                        kernel_regularizer=regularization,
-                        use_bias=False)(x)
+                    use_bias=False)(x)
 x = BatchNormalization()(x)
 x = MaxPooling2D((3, 3), strides=(2, 2), padding='same')(x)
 x = layers.add([x, residual])
 
-x = Conv2D(num_classes, (3, 3), padding='same')(x)
+# Widened to 8 filters to fit the Tensor Core tiles, the extra logit is 
+# sliced off before the softmax
+x = Conv2D(8, (3, 3), padding='same')(x)
 x = GlobalAveragePooling2D()(x)
-output = Activation('softmax', name='predictions')(x)
+x = x[:, :num_classes]
+# Softmax stays in float32 for numerical stability
+output = Activation('softmax', name='predictions', dtype='float32')(x)
 
 model = Model(img_input, output)
 
 # Prevents the first couple layers from being trained
 if fine_tune:
-    for layer in model.layers[:10]:
+    for layer in model.layers[:frozen_layers]:
         layer.trainable = False
         
-# Loading saved models, if any
+# Loading saved models, if any. Fine tuning needs one, otherwise the frozen 
+# layers would stay at their random initialization.
 try:
     model.load_weights(Path('models/model.best.hdf5'))
     print('LOADING SAVED MODEL...')
-except:
+except (OSError, ValueError) as error:
+    if fine_tune:
+        raise RuntimeError('Fine tuning needs a saved model that fits the '
+                           'current architecture, set fine_tune to False to '
+                           'train from scratch.') from error
     print('NO SAVED MODEL DETECTED...')
 
-# Optimizers    
-model.compile(optimizer='adam', 
+# Optimizers, the AdamW update is compiled by XLA into one fused kernel and 
+# float16 needs loss scaling to avoid gradient underflow. Weight decay is 
+# applied in the update instead of as a loss penalty and skips the 
+# BatchNormalization parameters and biases.
+optimizer = AdamW(learning_rate, weight_decay=weight_decay, jit_compile=True)
+optimizer.exclude_from_weight_decay(var_names=['gamma', 'beta', 'bias'])
+if precision_policy == 'mixed_float16':
+    optimizer = mixed_precision.LossScaleOptimizer(optimizer)
+model.compile(optimizer=optimizer, 
               loss='categorical_crossentropy', 
               metrics=['accuracy'])
 
+# When fine tuning, the frozen layers run outside the gradient tape and only 
+# the layers after them are trained. Any tensor leaving the frozen layers, 
+# like the one into the first residual branch, becomes an input of the rest.
+training_model = model
+if fine_tune:
+    frozen_outputs = {id(layer.output) 
+                      for layer in model.layers[:frozen_layers]}
+    features = {}
+    for layer in model.layers[frozen_layers:]:
+        for tensor in tf.nest.flatten(layer.input):
+            if id(tensor) in frozen_outputs:
+                features[id(tensor)] = tensor
+    frozen_model = Model(img_input, list(features.values()))
+    training_model = Model(list(features.values()), output)
+    training_model.compile(optimizer=optimizer, 
+                           loss='categorical_crossentropy', 
+                           metrics=['accuracy'])
+
 # Callbacks
 log_path = Path('logs/model_log.log')
 reduce_lr = ReduceLROnPlateau('val_loss', factor=0.1, 
@@ -185,12 +257,65 @@ callback_list = [checkpoint,
                  EarlyStopping('val_loss', patience=wait_time),
                  reduce_lr]
 
+# Training steps, the batches are augmented on the device with the same 
+# settings as the old ImageDataGenerator. XLA compiles the update and test 
+# steps, fusing the Conv, BatchNormalization and ReLU chains, and the fixed 
+# batch shapes let it compile each step exactly once, without any retracing.
+batch_signature = [tf.TensorSpec((batch_size,) + input_shape, X_train.dtype),
+                   tf.TensorSpec((batch_size, num_classes), Y_train.dtype)]
+
+@tf.function(input_signature=batch_signature, jit_compile=True)
+def update_step(x, y):
+    if fine_tune:
+        x = frozen_model(x, training=False)
+    return training_model.train_step((x, y))
+
+@tf.function(input_signature=[tf.TensorSpec((batch_size,), tf.int64)])
+def train_step(indices):
+    x = utils.augment(tf.gather(X_train, indices))
+    x = tf.pad(x, channel_padding)
+    y = tf.gather(Y_train, indices)
+    return update_step(x, y)
+
+@tf.function(input_signature=batch_signature, jit_compile=True)
+def test_step(x, y):
+    if fine_tune:
+        x = frozen_model(x, training=False)
+    return training_model.test_step((x, y))
+
 # Start the training
 print('TRAINING THE MODEL....')
-model.fit_generator(datagen.flow(X_train, Y_train, batch_size),
-                    steps_per_epoch=len(X_train) / batch_size,
-                    epochs=num_epochs, 
-                    verbose=1,
-                    validation_data=(X_val, Y_val), 
-                    callbacks=callback_list,
-                    validation_steps=len(X_val) / batch_size)
\ No newline at end of file
+callbacks = CallbackList(callback_list, add_progbar=True, model=model,
+                         verbose=1, epochs=num_epochs, steps=steps_per_epoch)
+callbacks.on_train_begin()
+for epoch in range(num_epochs):
+    training_model.reset_metrics()
+    callbacks.on_epoch_begin(epoch)
+    for step, indices in enumerate(train_ds):
+        callbacks.on_train_batch_begin(step)
+        logs = train_step(indices)
+        callbacks.on_train_batch_end(step, logs)
+    epoch_logs = {name: float(value) for name, value in logs.items()}
+    
+    training_model.reset_metrics()
+    for x, y in val_batches:
+        logs = test_step(x, y)
+    epoch_logs.update({'val_' + name: float(value) 
+                       for name, value in logs.items()})
+    callbacks.on_epoch_end(epoch, epoch_logs)
+    if model.stop_training:
+        break
+callbacks.on_train_end()
+
+# Folds the BatchNormalization layers of the best model for deployment
+model.load_weights(model_path)
+folded_model = deploy.fold_batchnorm(model)
+folded_model.save(str(Path('models/model.folded.hdf5')))
+print('FOLDED MODEL SAVED.')
+
+# Quantizes the folded model to INT8 for inference
+tflite_model = deploy.quantize(folded_model, 
+                               utils.pad_channels(X_val.numpy(), 
+                                                  input_shape[-1]))
+Path('models/model.int8.tflite').write_bytes(tflite_model)
+print('QUANTIZED MODEL SAVED.')
\ No newline at end of file
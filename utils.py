@@ -15,14 +15,16 @@ from pathlib import Path
 
 import pandas as pd
 import numpy as np
+import tensorflow as tf
 
-from keras.utils.np_utils import to_categorical
+from tensorflow.keras.utils import to_categorical
 
-def load_data(classes, filepath, usage='Training', debug=False):
+def load_data(classes, filepath, usage='Training', debug=False,
+              dtype='float32'):
     """Loads the dataset and reshapes the data for training or testing.
     
-    Returns X, the input data for our model, and Y, the expected 
-    label for each picture. 
+    Returns X, the input data for our model cast to dtype, and Y, the 
+    expected label for each picture. 
     """
     df = pd.read_csv(filepath)
     df = df[df.Usage == usage]  
@@ -34,24 +36,62 @@ def load_data(classes, filepath, usage='Training', debug=False):
         # Shuffles dataset
         data = df.sample(frac=1)    
         
-    # Reshapes the list of pixels into 48x48 arrays  
-    pixels = list(data["pixels"])    
-    X = []
-    for i in range(len(pixels)):
-        X.append([int(num) for num in pixels[i].split()])   
-    X = np.array(X)
-    X = X.reshape(X.shape[0], 48, 48, 1)
+    # Parses all the pixel strings at once and reshapes them into 48x48 arrays
+    X = np.fromstring(' '.join(data["pixels"]), dtype=np.uint8, sep=' ')
+    X = X.reshape(len(data), 48, 48, 1)
     X = X.astype("float32")
     # Rescales the images
     X /= 255
     X -= 0.5
     X *= 2.0
+    X = X.astype(dtype, copy=False)
     
     # Creates an array of "emotion" label for each input
     Y = data.emotion.values
-    Y = to_categorical(Y)
+    Y = to_categorical(Y, num_classes=len(classes))
     return X, Y
 
+def augment(images, rotation=10, shift=0.1, zoom=0.1):
+    """Randomly rotates, shifts, zooms and horizontally flips a batch of 
+    images with TensorFlow ops, like ImageDataGenerator does.
+    
+    Rotation is in degrees, shift and zoom are fractions of the image size.
+    Rotation, shift and zoom are combined into one transform per image and
+    applied in the dtype of the images.
+    """
+    batch = tf.shape(images)[0]
+    height = tf.cast(tf.shape(images)[1], tf.float32)
+    width = tf.cast(tf.shape(images)[2], tf.float32)
+    angle = tf.random.uniform([batch], -rotation, rotation) * np.pi / 180
+    shift_x = tf.random.uniform([batch], -shift, shift) * width
+    shift_y = tf.random.uniform([batch], -shift, shift) * height
+    zoom_x = tf.random.uniform([batch], 1 - zoom, 1 + zoom)
+    zoom_y = tf.random.uniform([batch], 1 - zoom, 1 + zoom)
+    
+    # Maps each output pixel to its input pixel, around the image center
+    center_x = (width - 1) / 2
+    center_y = (height - 1) / 2
+    a0 = zoom_x * tf.cos(angle)
+    a1 = -zoom_y * tf.sin(angle)
+    b0 = zoom_x * tf.sin(angle)
+    b1 = zoom_y * tf.cos(angle)
+    a2 = center_x - a0 * center_x - a1 * center_y + shift_x
+    b2 = center_y - b0 * center_x - b1 * center_y + shift_y
+    zeros = tf.zeros([batch])
+    transforms = tf.stack([a0, a1, a2, b0, b1, b2, zeros, zeros], axis=1)
+    
+    images = tf.raw_ops.ImageProjectiveTransformV3(
+        images=images, transforms=transforms,
+        output_shape=tf.shape(images)[1:3], fill_value=0.0,
+        interpolation='BILINEAR', fill_mode='NEAREST')
+    return tf.image.random_flip_left_right(images)
+
+def pad_channels(X, channels):
+    """Zero pads the channel axis of a batch of NHWC images to channels.
+    """
+    padding = [(0, 0)] * (X.ndim - 1) + [(0, channels - X.shape[-1])]
+    return np.pad(X, padding)
+
 def save_data(X, Y, filename=''):
     """Saves the X and Y numpy arrays from load_data to user directory.
     """